@@ -538,11 +538,11 @@ class Bot(EventEmitter):
                 del self.target_throttles[k]
 
         def _relay(*args, **kwargs):
-            self.global_throttle.add(*args, **kwargs)
+            self.global_throttle.add_cost(*args, **kwargs)
             return self.eventloop.schedule(self.global_throttle.run)
 
         if not target:
-            self.global_throttle.add(cost, target)
+            self.global_throttle.add_cost(cost, fn)
             return self.eventloop.schedule(self.global_throttle.run)
 
         throttle = self.target_throttles.get(target)
@@ -558,7 +558,7 @@ class Bot(EventEmitter):
             throttle = Throttle(burst, rate, on_clear=functools.partial(_on_clear, target))
             self.target_throttles[target] = throttle
             self.eventloop.schedule(throttle.run)
-        throttle.add(cost, _relay, cost, fn)
+        throttle.add_cost(cost, _relay, cost, fn)
 
     def _unthrottled(self, fn):
         @functools.wraps(fn)
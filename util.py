@@ -6,7 +6,9 @@ import functools
 import concurrent.futures
 import asyncio
 import itertools
+import logging
 import re
+import time
 import tornado.locks
 import tornado.gen
 import tornado.concurrent
@@ -14,6 +16,35 @@ import pydle.async
 
 __all__ = ["listify", "pad", "DependencyDict", "DependencyItem", "Throttle", "patternize"]
 
+logger = logging.getLogger(__name__)
+
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:  # Python < 3.7
+    def _monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+
+#: Shared empty frozenset, used instead of allocating a new one for every empty dependency set.
+_EMPTY = frozenset()
+
+#: functools.partial, bound once for :meth:`Throttle._item`.
+_partial = functools.partial
+
+#: Types that :func:`listify` treats as a single item rather than a sequence.
+_STR_OR_BYTES = (str, bytes)
+
+
+def _awaitable(future):
+    """
+    Returns something that can be awaited on in place of `future`.
+
+    Everything we consider a future is awaitable as-is except for :class:`concurrent.futures.Future`, which needs to be
+    wrapped first.
+    """
+    if isinstance(future, concurrent.futures.Future):
+        return asyncio.wrap_future(future)
+    return future
+
 
 def listify(x):
     """
@@ -29,7 +60,12 @@ def listify(x):
     """
     if x is None:
         return []
-    if isinstance(x, (str, bytes)):
+    t = type(x)
+    if t is str or t is bytes:
+        return [x]
+    if t is list or t is tuple:
+        return x
+    if isinstance(x, _STR_OR_BYTES):  # Subclasses.
         return [x]
     return x
 
@@ -47,11 +83,21 @@ def pad(iterable, size, padding=None):
     :param size: Number of elements to yield.
     :param padding: What to yield after the iterator is exhausted.
     """
-    for item in iterable:
+    try:
+        count = len(iterable)
+    except TypeError:
+        return _pad(iterable, size, padding)
+    # We know how much padding is needed up front, so let itertools do all of the work.
+    return itertools.chain(iterable, itertools.repeat(padding, max(size - count, 0)))
+
+
+def _pad(iterable, size, padding):
+    """Implements :func:`pad` for iterables with no length."""
+    count = 0
+    for count, item in enumerate(iterable, 1):
         yield item
-        size -= 1
-    if size > 0:
-        yield from itertools.repeat(padding, size)
+    if size > count:
+        yield from itertools.repeat(padding, size - count)
 
 
 class Throttle:
@@ -63,20 +109,27 @@ class Throttle:
     one event is guaranteed to execute when the bucket is full, even if the event's cost exceeds the total capacity.
 
     The event queue is a `collections.deque` consisting of (cost, function) tuples.  Events are removed from the head
-    of the queue if there's at least `cost` units available in the bucket.
+    of the queue if there's at least `cost` units available in the bucket.  :meth:`run` is the only consumer, and is
+    woken through `_wake_condition`.
+
+    Internally, the bucket is tracked in integer nanoseconds: one unit is worth `rate` nanoseconds, so the bucket holds
+    up to ``burst * rate`` and gains `amount` for every nanosecond that passes.  This keeps the accounting exact over
+    long uptimes.
 
     :ivar burst: Maximum bucket capacity (must be > 0)
-    :ivar rate: Replenishment rate (must be >= 0, a replenishment rate of 0 disables all actual throttling mechanics.)
+    :ivar rate: Replenishment rate in seconds (must be >= 0, a replenishment rate of 0 disables all actual throttling
+        mechanics.)
     :ivar amount: How much is replenished. (must be > 0)
     :ivar queue: Event queue.
-    :ivar _wake_condition: Internal condition for waking up the event loop.
+    :ivar _wake_condition: Internal condition for waking up the event loop.  :meth:`run` is the only legitimate
+        waiter, so it is only ever notified with ``notify(1)``.
     """
     _FUTURE_CLASSES = (pydle.async.Future, tornado.concurrent.Future, asyncio.Future, concurrent.futures.Future)
-    ZEROTIME = datetime.timedelta()
-    _now = datetime.datetime.now
+    _FUTURE_TYPES = frozenset(_FUTURE_CLASSES)  # For exact type checks.
+    _now = staticmethod(_monotonic_ns)
     # _m = 0
 
-    def __init__(self, burst, rate, amount=1, on_clear=None):
+    def __init__(self, burst, rate, amount=1, on_clear=None, maxlen=None):
         """
         Creates a new Throttle.
 
@@ -86,36 +139,73 @@ class Throttle:
         :param amount: How many units are recharged every `rate`.  Must be > 0
         :param on_clear: Function called when the queue is empty and the bucket is full, or None.  Receives the throttle
             as an argument.
+        :param maxlen: Maximum number of pending events, or None for no limit.  Once the queue is full, adding an event
+            silently discards the oldest pending one.
         """
-        if not isinstance(rate, datetime.timedelta):
-            rate = datetime.timedelta(seconds=rate)
+        self.queue = collections.deque(maxlen=maxlen)
+        self.on_clear = on_clear
+        self._wake_condition = tornado.locks.Condition()
+        self._waiting = 0  # How many times run() is currently waiting on _wake_condition (0 or 1).
+        self._waking = False  # True if run() has already been notified during its current wait.
+        self._stop_event = tornado.locks.Event()  # Set when run() has been asked to stop.
+        self._done_event = tornado.locks.Event()  # Set whenever run() isn't running.
+        self._done_event.set()
+        self.running = False
+        self.burst = burst
+        self.amount = amount
         self.rate = rate
-        if self.rate < self.ZEROTIME:
-            raise ValueError('rate cannot be < 0 seconds')
         if self.rate:
             # Don't bother validating these if rate is zero, since they won't do anything.
             if burst <= 0:
                 raise ValueError('burst must be > 0')
             if amount <= 0:
                 raise ValueError('amount must be > 0')
-        self.burst = burst
-        self.free = burst
-        self.amount = amount
-        self.last = self._now()
-        self.queue = collections.deque()
-        self.on_clear = on_clear
-        self._wake_condition = tornado.locks.Condition()
-        self._stop_condition = None
-        self.running = False
+        self._scale_ns = self._rate_ns  # The rate that _free_scaled is currently expressed in; 0 means a full bucket.
+        self._free_scaled = burst * self._rate_ns
+        self._last_ns = self._now()
         # self._m = type(self)._m
         # type(self)._m += 1
         # self._n = 0
 
+    @property
+    def rate(self):
+        """
+        Replenishment rate in seconds.  May be set to a number or a :class:`datetime.timedelta`; changes take effect on
+        :meth:`run`'s next pass.
+        """
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        # The bucket itself is rescaled by run() at the start of its next pass, since run() may be partway through one.
+        if isinstance(rate, datetime.timedelta):
+            rate = rate.total_seconds()
+        rate = float(rate)
+        if rate < 0:
+            raise ValueError('rate cannot be < 0 seconds')
+        self._rate = rate
+        self._rate_ns = round(rate * 1000000000)
+        if not self._rate_ns:
+            self._scale_ns = 0  # Throttling is disabled, so the bucket is full.
+        self.wake()
+
+    @property
+    def free(self):
+        """Number of units available in the bucket as of the last time it was refilled."""
+        if not self._scale_ns:
+            return self.burst
+        return self._free_scaled / self._scale_ns
+
     def wake(self):
         """
         Called when something is added to the queue in case we're waiting for something.
+
+        Does nothing unless :meth:`run` is actually waiting, which it isn't while it's busy draining the queue.  Only
+        the first call during any given wait notifies; the rest would have nothing left to wake.
         """
-        self._wake_condition.notify_all()
+        if self._waiting and not self._waking:
+            self._waking = True
+            self._wake_condition.notify(1)
 
     def _item(self, *args, **kwargs):
         """
@@ -125,8 +215,10 @@ class Throttle:
             cost, *args = args
         else:
             cost = 1
-        item = (cost, functools.partial(*args, **kwargs))
-        return item
+        if len(args) == 1 and not kwargs:
+            # Nothing to bind, so there's no need to wrap it in a partial.
+            return cost, args[0]
+        return cost, _partial(*args, **kwargs)
 
     def add(self, *args, **kwargs):
         """
@@ -141,6 +233,21 @@ class Throttle:
         self.queue.append(self._item(*args, **kwargs))
         self.wake()
 
+    def add_cost(self, cost, fn, *args, **kwargs):
+        """
+        Adds an item with an explicit cost to the event queue.
+
+        Equivalent to ``self.add(cost, fn, *args, **kwargs)``, but doesn't need to work out which argument is the
+        callable.
+
+        :param cost: Event cost.
+        :param fn: Callable.  Remaining args and kwargs will be bound to it.
+        """
+        if args or kwargs:
+            fn = _partial(fn, *args, **kwargs)
+        self.queue.append((cost, fn))
+        self.wake()
+
     def extend(self, items):
         """
         Adds the collection of items to the queue.
@@ -154,41 +261,91 @@ class Throttle:
           ``args = item.pop(None); self.add(*item[None], **item``
         - A sequence, in which case this is equivalent to ``self.add(*item)``
         """
-        def _gen():
-            for item in items:
-                if callable(item):
-                    yield self._item(1, item)
-                elif hasattr(item, 'keys'):
-                    item = dict(item)
-                    args = item.pop(None)
-                    yield self._item(*args, **item)
-                else:
-                    yield self._item(*item)
-        self.queue.extend(item for item in _gen())
+        # This is _item() inlined, since it runs for every item in the batch.  Appending directly rather than feeding a
+        # generator to deque.extend() avoids resuming a generator frame for every item.
+        append = self.queue.append
+        for item in items:
+            # Plain tuples and lists are recognized by type first, since neither can be callable or a mapping.
+            t = type(item)
+            if t is tuple or t is list:
+                kwargs = None
+                first, *args = item
+            elif callable(item):
+                append((1, item))  # Nothing to bind, so this is exactly what _item() would produce.
+                continue
+            elif t is dict or hasattr(item, 'keys'):
+                kwargs = dict(item)
+                first, *args = kwargs.pop(None)
+            else:
+                kwargs = None
+                first, *args = item
+            if callable(first):
+                cost, fn = 1, first
+            else:
+                cost = first
+                fn, *args = args
+            if kwargs:
+                fn = _partial(fn, *args, **kwargs)
+            elif args:
+                fn = _partial(fn, *args)
+            append((cost, fn))
         self.wake()
 
     def is_future(self, value):
         """
         Returns True if the value is something we consider a future.
 
+        Instances of exactly one of :attr:`_FUTURE_CLASSES` are recognized with a single set lookup.  Anything else is
+        duck-typed: anything with ``add_done_callback`` and ``result`` qualifies, which covers subclasses (such as
+        :class:`asyncio.Task`) without walking each class's MRO.
+
         :param value: Value to test.
         """
-        return isinstance(value, self._FUTURE_CLASSES)
+        if value is None:
+            return False
+        if type(value) in self._FUTURE_TYPES:
+            return True
+        return hasattr(value, 'add_done_callback') and hasattr(value, 'result')
 
     def stop(self):
         """
         Causes run() to stop the next time it gets a chance to do so.
         """
-        self._stop_condition = tornado.locks.Condition()
-        self._wake_condition.notify_all()
+        self._stop_event.set()
+        self.wake()
 
-    @pydle.async.coroutine
-    def wait_for_stop(self):
+    async def wait_for_stop(self):
         self.stop()
-        yield self._stop_condition.wait()
+        await self._done_event.wait()
+
+    async def _run_unthrottled(self):
+        """
+        Implements :meth:`run` while `rate` is 0.
 
-    @pydle.async.coroutine
-    def run(self):
+        Throttling is disabled, so this skips the bucket entirely and dispatches everything as soon as it arrives.
+        Returns when stopped or when `rate` becomes nonzero.
+        """
+        queue = self.queue
+        popleft = queue.popleft
+        stopping = self._stop_event.is_set
+        while not stopping() and not self._rate_ns:
+            while queue:
+                result = popleft()[1]()
+                if result is not None and self.is_future(result):
+                    await _awaitable(result)
+                    if stopping():
+                        break
+            if self.on_clear and not queue:
+                self.on_clear(self)
+            if not queue and not stopping() and not self._rate_ns:
+                self._waiting += 1
+                self._waking = False
+                try:
+                    await self._wake_condition.wait()
+                finally:
+                    self._waiting -= 1
+
+    async def run(self):
         """
         Actually handles the throttling queue.
         """
@@ -196,66 +353,100 @@ class Throttle:
             return False
         try:
             self.running = True
-            self._stop_condition = None
-            while not self._stop_condition:
+            self._stop_event.clear()
+            self._done_event.clear()
+            queue = self.queue
+            popleft = queue.popleft
+            clock = self._now  # A staticmethod, so this is the plain clock function with no binding overhead.
+            stopping = self._stop_event.is_set
+            is_future = self.is_future
+            while not stopping():
                 # self._n += 1
-                # Recover capacity
-                if self.rate and self.free < self.burst:
-                    # How much time has gone by?
-                    elapsed = self._now() - self.last
-                    ticks = elapsed / self.rate
-                    # Actually recover it.
-                    self.free = min(self.free + ticks*self.amount, self.burst)
-                    self.last += self.rate*ticks
-
-                # Flush the queue.
-                while self.queue:
-                    cost = self.queue[0][0]
-                    if self.free >= self.burst:
-                        # Reset self.last to now so the timer is accurate.
-                        self.last = self._now()
-                    elif cost > self.free:
+                if not self._rate_ns:
+                    await self._run_unthrottled()
+                    continue
+                # Hot attributes are cached as locals; free and last are written back whenever we await.
+                rate, amount = self._rate_ns, self.amount
+                capacity = self.burst*rate
+                free, last = self._free_scaled, self._last_ns
+                if rate != self._scale_ns:
+                    # rate changed since the last pass, so express the bucket in terms of the new one.
+                    free = free*rate // self._scale_ns if self._scale_ns else capacity
+                    self._free_scaled, self._scale_ns = free, rate
+                # Everything dispatched in this batch shares a single timestamp; it's only resampled after awaiting.
+                now = clock()
+                # Recover capacity.  This is a single step, skipped outright if the bucket is already full; either way,
+                # moving last up to now keeps it from banking time it had no room for.
+                if free < capacity:
+                    free += (now - last)*amount
+                    if free > capacity:
+                        free = capacity
+                last = now
+
+                # Flush the queue.  This drains as much as the bucket allows in one go: free is a local that's only
+                # written back when we await or the batch ends, and an affordable event costs a single comparison.
+                while queue:
+                    head = queue[0]
+                    cost = head[0]*rate
+                    if cost > free and free < capacity:
                         # Can't handle this item yet.  How long would it take to fix that?
-                        deficit = min(cost, self.burst) - self.free
-                        ticks = deficit / self.amount
-                        timeout = (self.last + self.rate*ticks - self._now()).total_seconds()
-                        if timeout > 0:
-                            yield tornado.gen.sleep(timeout)
+                        # (Both sides are integers and free is short of the target, so this is always >= 1ns.)
+                        timeout = -(-(min(cost, capacity) - free) // amount)
+                        self._free_scaled, self._last_ns = free, last
+                        await asyncio.sleep(timeout / 1e9)
                         break  # Restart the loop at capacity recovery.
-                    event = self.queue.popleft()[1]
-                    self.free -= cost
-                    result = event()
-                    if self.is_future(result):
-                        yield result
-                        if self._stop_condition:
+                    popleft()
+                    free -= cost
+                    result = head[1]()
+                    if result is not None and is_future(result):
+                        self._free_scaled, self._last_ns = free, last
+                        await _awaitable(result)
+                        if stopping():
                             break
-
-                # Handle the potential lack of a queue.
-                if not self.queue:
+                        now = clock()
+                        if free < capacity:
+                            free += (now - last)*amount
+                            if free > capacity:
+                                free = capacity
+                        last = now
+                self._free_scaled, self._last_ns = free, last
+
+                # Handle the potential lack of a queue.  Events and on_clear can queue more work or call stop()
+                # without us waiting, so check for both before touching the condition; otherwise we'd sleep through a
+                # notify that already happened.
+                if not queue and not stopping():
                     try:
-                        if not self.on_clear or self.free >= self.burst:
+                        if not self.on_clear or free >= capacity:
                             # We don't care about when the queue is recharged, so sleep until we're awoken.
                             if self.on_clear:
                                 self.on_clear(self)
-                            yield self._wake_condition.wait()
+                                if queue or stopping():
+                                    continue
+                            self._waiting += 1
+                            self._waking = False
+                            try:
+                                await self._wake_condition.wait()
+                            finally:
+                                self._waiting -= 1
                             continue
-                        # Figure out how long until we'll be full.  Sleep at most that long.
-                        ticks = ((self.burst - self.free) / self.amount)
-                        timeout = ((self.last - self._now()) + (self.rate * ticks))
-                        if timeout > self.ZEROTIME:
-                            result = self._wake_condition.wait(timeout=timeout)
-                            yield result
+                        # Figure out how long until we'll be full.  Sleep at most that long.  (last is this pass's
+                        # timestamp, so there's no need to read the clock again.)
+                        timeout = -(-(capacity - free) // amount)
+                        self._waiting += 1
+                        self._waking = False
+                        try:
+                            await self._wake_condition.wait(timeout=datetime.timedelta(microseconds=timeout / 1000))
+                        finally:
+                            self._waiting -= 1
                         continue
                     except tornado.gen.TimeoutError:
                         continue
-        except Exception as ex:
-            import traceback
-            traceback.print_exc()
-            raise ex
+        except Exception:
+            logger.exception("Unhandled exception in throttle loop")
+            raise
         finally:
-            if self._stop_condition:
-                self._stop_condition.notify_all()
             self.running = False
+            self._done_event.set()
 
     def clear(self):
         """
@@ -285,40 +476,25 @@ class DependencyItem(
         :param data: Optional data to associate.
         :return: A new :class:`DependencyItem`
 
-        All dependencies are stored in sets and thus must be hashable.
+        All dependencies are stored in frozensets and thus must be hashable.  They're never modified once the item is
+        created; to change an item's dependencies, replace the item.
 
         Items in `before` and `required_by` should not be in `after` or `requires`.  Dependency sorting will fail
         if they are.
         """
-        before = set(before) if before else set()
-        after = set(after) if after else set()
-        required_by = set(required_by) if required_by else set()
-        requires = set(required_by) if required_by else set()
+        before = frozenset(before) if before else _EMPTY
+        after = frozenset(after) if after else _EMPTY
+        required_by = frozenset(required_by) if required_by else _EMPTY
+        requires = frozenset(requires) if requires else _EMPTY
         # noinspection PyTypeChecker
-        return super().__new__(cls, before, after, required_by, requires, priority, data)
-
-
-@functools.total_ordering
-class _DependencyPriority:
-    """Internal class used to identify dependency groups."""
-    def __init__(self, name):
-        self.name = name
-
-    def __repr__(self):
-        return "{0.__class__.__name__}({0.name!r})".format(self)
-
-    def __hash__(self):
-        return hash(self.name) ^ 0x20160307  # Arbitrary-ish xor
+        return super().__new__(
+            cls, before=before, after=after, requires=requires, required_by=required_by, priority=priority, data=data
+        )
 
-    def __eq__(self, other):
-        if not isinstance(type(other), type(self)):
-            raise TypeError
-        return self.name == other.name
 
-    def __le__(self, other):
-        if not isinstance(type(other), type(self)):
-            raise TypeError
-        return self.name < other.name
+#: Marks the synthetic nodes :meth:`DependencyDict.solve` uses for priority groups, which are
+#: ``(_PRIORITY_SENTINEL, priority)`` tuples and so can't collide with real keys.
+_PRIORITY_SENTINEL = object()
 
 
 class DependencyDict(collections.abc.MutableMapping):
@@ -344,17 +520,16 @@ class DependencyDict(collections.abc.MutableMapping):
     #: Class or factory that produces dependency items.
     ITEMCLASS = DependencyItem
 
-    #: Used in validating items and producing error messages.  (attr, verb, required, before)
-    _ITEM_ATTRINFO = (
-        ('before', 'is before', False, True), ('required_by', 'is required by', True, True),
-        ('after', 'is after', False, False), ('requires', 'requires', True, False)
-    )
+    #: Used in producing error messages.  {attr: verb}
+    _ITEM_VERBS = {'before': 'is before', 'required_by': 'is required by', 'after': 'is after', 'requires': 'requires'}
 
     __marker = object()
 
-    def __init__(self, key=False, get_priority=True):
+    def __init__(self, *items, key=False, get_priority=True):
         """
         Creates a new :class:`DependencyDict`.
+        :param items: Initial items.  Each is either a key or a tuple that is passed as positional arguments to
+            :meth:`add`.
         :param key: If `False`, no sorting is performed other than what dependency solving required.  Otherwise, passed
         as-is to functions that perform sorting.
         :param get_priority: If `False`, dependencies are not sorted by priority.  Otherwise, follows the same semantics
@@ -363,8 +538,17 @@ class DependencyDict(collections.abc.MutableMapping):
         self.sortkey = key
         self.get_priority = get_priority
         self._data = collections.OrderedDict()
+        # Views are live, so these never need to be refreshed.
+        self._keys, self._items, self._values = self._data.keys(), self._data.items(), self._data.values()
         self._solved = False  # True if we've performed sorting and whatnot.
         self._passes = None  # How many passes solving took.
+        self._pass_of = {}  # {key: pass number} as of the last solve.
+        self._level = None  # The priority shared by every item as of the last solve, or __marker if there's several.
+        for item in items:
+            if isinstance(item, tuple):
+                self.add(*item)
+            else:
+                self.add(item)
 
     def add(self, key, *args, **kwargs):
         """
@@ -377,35 +561,104 @@ class DependencyDict(collections.abc.MutableMapping):
         :param kwargs: Passed to DependencyItem constructor.
 
         If the item already exists in the set, before and after are merged with the existing contents.
-        If the set was already solved, renders it unsolved.
+        If the set was already solved, renders it unsolved -- unless the item is identical to what was already there.
 
         Passing nothing but `key` is perfectly valid and creates an item with no explicit dependencies.
         """
-        self._data[key] = self.ITEMCLASS(*args, **kwargs)
-        self._solved = False
+        self._store(key, self.ITEMCLASS(*args, **kwargs))
+
+    def _store(self, key, value):
+        """
+        Stores `value` under `key`, only discarding the current solution if the item actually changed.
+
+        New items that can simply go on the end of the current solution are appended to it instead.
+        """
+        if self._solved:
+            existing = self._data.get(key, self.__marker)
+            if existing is self.__marker:
+                self._solved = self._can_append(key, value)
+            elif existing != value:
+                self._solved = False
+        self._data[key] = value
+
+    def _can_append(self, key, value):
+        """
+        Returns True if a new item can be added to the end of an already-solved dictionary without re-solving.
+
+        This is only the case if the result is exactly what :meth:`solve` would produce: nothing already present has
+        to come after it, it doesn't need to come before anything already present, everything it requires is present,
+        everything present has the same priority as it does, and it belongs in the last pass or a new one after it.
+        Anything else falls back to a full :meth:`solve`.  If this returns True, the item's pass has been recorded.
+
+        :param key: Key of the new item.
+        :param value: The new item.
+        """
+        if self.sortkey is not False or value.required_by:
+            return False
+        if key in value.before or key in value.after or key in value.requires:
+            return False  # Let solve() complain about it.
+        if self.get_priority:
+            level = self.get_priority(value.priority) if callable(self.get_priority) else value.priority
+        else:
+            level = None
+        if not self._data:
+            self._pass_of = {key: 1}
+            self._passes = 1
+            self._level = level
+            return True
+        keys = self._data.keys()
+        if value.before & keys or value.requires - keys:
+            return False
+        if self.get_priority and (self._level is self.__marker or level != self._level):
+            return False
+
+        # The item's pass is one after the latest of everything that has to come before it.
+        pass_of = self._pass_of
+        n = 0
+        for other in value.after & keys:
+            if pass_of[other] > n:
+                n = pass_of[other]
+        for other in value.requires:
+            if pass_of[other] > n:
+                n = pass_of[other]
+        for k, other in self._data.items():
+            if key in other.after or key in other.requires:
+                return False
+            if (key in other.before or key in other.required_by) and pass_of[k] > n:
+                n = pass_of[k]
+        n += 1
+        if n < self._passes:
+            return False
+        pass_of[key] = n
+        self._passes = n
+        return True
 
     def clear(self):
-        self._data = {}
+        self._data.clear()
         self._solved = True  # Because there's zero elements!
 
     def pop(self, key, default=__marker):
-        if default is self.__marker:
-            result = super().pop(key)
-        else:
-            result = super().pop(key, default)
-        self._solved = not len(self._data)
+        result = self._data.pop(key, self.__marker)
+        if result is self.__marker:
+            if default is self.__marker:
+                raise KeyError(key)
+            return default
+        self._solved = not self._data
         return result
 
     def popitem(self):
-        result = super().popitem()
-        self._solved = not len(self._data)
+        """Removes and returns the first (key, item) pair in dependency order."""
+        if not self._data:
+            raise KeyError('popitem(): dictionary is empty')
+        if not self._solved:
+            self.solve()
+        result = self._data.popitem(last=False)
+        self._solved = not self._data
         return result
 
     def __setitem__(self, key, value):
         if isinstance(value, self.ITEMCLASS):
-            self._data[key] = value
-            self._solved = False
-            return
+            return self._store(key, value)
         if not value:
             value = tuple()
         elif hasattr(value, 'keys') and hasattr(value, '__getitem__'):
@@ -424,97 +677,157 @@ class DependencyDict(collections.abc.MutableMapping):
 
     def unsorted_keys(self):
         """Returns dictionary keys in an undetermined order.  Will not solve dependencies."""
-        return self._data.keys()
+        return self._keys
 
     def unsorted_values(self):
         """Returns dictionary values in an undetermined order.  Will not solve dependencies."""
-        return self._data.values()
+        return self._values
 
     def unsorted_items(self):
         """Returns dictionary items in an undetermined order.  Will not solve dependencies."""
-        return self._data.items()
+        return self._items
+
+    def _dependency_error(self, key, attr, missing=__marker):
+        """
+        Returns (but does not raise) the exception for an invalid dependency.
+
+        :param key: Key of the item with the invalid dependency.
+        :param attr: Dependency attribute, e.g. 'before'
+        :param missing: The missing item, if the item depends on one.  Otherwise, the item depends on itself.
+        """
+        verb = self._ITEM_VERBS[attr]
+        if missing is self.__marker:
+            return RuntimeError("Item {!r} {} itself.".format(key, verb), key, attr)
+        return RuntimeError("Item {!r} {} missing item {!r}.".format(key, verb, missing), key, attr, missing)
 
     def solve(self):
         """Solves dependencies and performs a topological sort."""
         if not self._data:
             self._solved = True
             return
-        pending = collections.OrderedDict((k, set()) for k in self._data)
-        keys = pending.keys()
+        # Dependency state is kept in parallel flat dicts rather than one set per item.  indegree counts the edges
+        # leading into each item and dependents lists the edges leading out of it; an edge that's declared from both
+        # ends is simply counted twice, which Kahn's algorithm below doesn't mind.
+        position = {k: ix for ix, k in enumerate(self._data)}
+        keys = self._data.keys()  # Validation is always against the input, not any of the working tables.
+        indegree = dict.fromkeys(position, 0)
+        dependents = collections.defaultdict(list)
+        priorities = None
         if self.get_priority:
-            priorities = collections.defaultdict(list)
-            get_priority = self.get_priority if callable(self.get_priority) else lambda x: x
-        else:
-            priorities = None
-            get_priority = None
+            # Most dictionaries only use one priority, so find out whether grouping is needed at all before building
+            # any groups.
+            if callable(self.get_priority):
+                levels = [self.get_priority(v.priority) for v in self._data.values()]
+            else:
+                levels = [v.priority for v in self._data.values()]
+            if len(set(levels)) > 1:
+                self._level = self.__marker
+                priorities = collections.defaultdict(list)
+                for k, level in zip(self._data, levels):
+                    priorities[level].append(k)
+            else:
+                self._level = levels[0]
 
-        # Validate everything and set up pending.
+        # Validate everything and build the graph.  Each of the four dependency attributes gets its own block rather
+        # than going through a table, since this runs for every item.  Empty sets are skipped outright.
         for k, v in self._data.items():
-            for attr, verb, required, before in self._ITEM_ATTRINFO:
-                items = getattr(v, attr)
+            # Forward edges: k comes before these.
+            items = v.before
+            if items:
                 if k in items:
-                    raise RuntimeError("Item {!r} {} itself.".format(k, verb), k, attr)
-                if required:
-                    missing = items - keys
-                    if missing:
-                        missing = missing.pop()
-                        raise RuntimeError("Item {!r} {} missing item {!r}.".format(k, verb, missing), k, attr, missing)
-                    overlap = items
-                else:
-                    overlap = items & keys
-
-                if before:
-                    for other in overlap:
-                        pending[other].add(k)
-                    continue
-                pending[k].update(overlap)
-
-            if get_priority:
-                priorities[get_priority(v.priority)].append(k)
+                    raise self._dependency_error(k, 'before')
+                items = items & keys
+                dependents[k].extend(items)
+                for other in items:
+                    indegree[other] += 1
+            items = v.required_by
+            if items:
+                if k in items:
+                    raise self._dependency_error(k, 'required_by')
+                missing = items - keys
+                if missing:
+                    raise self._dependency_error(k, 'required_by', missing.pop())
+                dependents[k].extend(items)
+                for other in items:
+                    indegree[other] += 1
+
+            # Back edges: k comes after these.
+            items = v.after
+            if items:
+                if k in items:
+                    raise self._dependency_error(k, 'after')
+                items = items & keys
+                indegree[k] += len(items)
+                for other in items:
+                    dependents[other].append(k)
+            items = v.requires
+            if items:
+                if k in items:
+                    raise self._dependency_error(k, 'requires')
+                missing = items - keys
+                if missing:
+                    raise self._dependency_error(k, 'requires', missing.pop())
+                indegree[k] += len(items)
+                for other in items:
+                    dependents[other].append(k)
 
         # Sort groups and handle dependencies
         # We handle group dependencies by:
         # a) Making all members of a group dependent on the previous group.
         # b) Making the group dependent on all members of the group.
-        if priorities and len(priorities) == 1:  # Ignore the overhead if there's only one group.
-            priorities = None
-            get_priority = None
-
         if priorities:
             prev = None
             for priority in sorted(priorities.keys()):
                 members = set(priorities[priority])
-                priority = _DependencyPriority(priority)
+                priority = (_PRIORITY_SENTINEL, priority)
                 if prev:
+                    dependents[prev].extend(members)
                     for member in members:
-                        pending[member].add(prev)
-                pending[priority] = set(members)
+                        indegree[member] += 1
+                position[priority] = len(position)
+                indegree[priority] = len(members)
+                for member in members:
+                    dependents[member].append(priority)
                 prev = priority
 
-        # Actually solve.
+        # Actually solve, using Kahn's algorithm.  Items are released in passes: each pass holds the items whose
+        # dependencies were all released by earlier passes, in insertion order, then stable-sorted by sortkey if we
+        # have one.
         solution = []
+        pass_of = self._pass_of = {}
+        sortkey = self.sortkey
+        # Plain dicts aren't ordered on every Python we support, so put the first pass in insertion order explicitly.
+        solved = sorted((k for k, v in indegree.items() if not v), key=position.__getitem__)
         n = 0
-        while pending:
+        while solved:
             n += 1
-            # Find items with no (remaining) dependencies.
-            if self.sortkey is False:
-                solved = list(k for k, v in pending.items() if not v)
-            else:
-                solved = list(item[0] for item in sorted(filter(lambda x: not x[1], pending.items()), key=self.sortkey))
-            if not solved:
-                raise RuntimeError(
-                    "Could not solve dependencies on pass {} ({} items remaining)".format(n, len(pending)),
-                    n, len(pending)
-                )
-
+            if sortkey is not False:
+                # Only this pass's ready items are sorted, so this is O(N log N) over the whole solve.
+                solved = [item[0] for item in sorted([(k, _EMPTY) for k in solved], key=sortkey)]
             solution.extend(solved)
+            pass_of.update(zip(solved, itertools.repeat(n)))
+            ready = []
             for item in solved:
-                del pending[item]
-            for v in pending.values():
-                v.difference_update(solved)
-        self._data = collections.OrderedDict(
-            (k, self._data[k]) for k in solution if not isinstance(k, _DependencyPriority)
-        )
+                for other in dependents.get(item, ()):
+                    count = indegree[other] - 1
+                    indegree[other] = count
+                    if not count:
+                        # No (remaining) dependencies, so it goes in the next pass.
+                        ready.append(other)
+            ready.sort(key=position.__getitem__)
+            solved = ready
+
+        if len(solution) != len(position):
+            remaining = len(position) - len(solution)
+            raise RuntimeError(
+                "Could not solve dependencies on pass {} ({} items remaining)".format(n + 1, remaining),
+                n + 1, remaining
+            )
+        # Reorder in place rather than building a second dictionary.
+        move_to_end = self._data.move_to_end
+        for k in solution:
+            if not (type(k) is tuple and len(k) == 2 and k[0] is _PRIORITY_SENTINEL):
+                move_to_end(k)
         self._solved = True
         self._passes = n
 
@@ -526,17 +839,17 @@ class DependencyDict(collections.abc.MutableMapping):
     def keys(self):
         if not self._solved:
             self.solve()
-        return self._data.keys()
+        return self._keys
 
     def items(self):
         if not self._solved:
             self.solve()
-        return self._data.items()
+        return self._items
 
     def values(self):
         if not self._solved:
             self.solve()
-        return self._data.values()
+        return self._values
 
     def __len__(self):
         return len(self._data)
@@ -562,29 +875,37 @@ def patternize(pattern, flags=re.IGNORECASE, attr='fullmatch'):
     """
     if not callable(pattern):
         if isinstance(pattern, str):
-            pattern = re.compile(pattern, flags)
+            return _compile_pattern(pattern, flags, attr)
         pattern = getattr(pattern, attr)
     return pattern
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_pattern(pattern, flags, attr):
+    """Implements :func:`patternize` for strings, so that registering the same pattern repeatedly is cheap."""
+    return getattr(re.compile(pattern, flags), attr)
 #
 #
 # if __name__ == '__main__':
-#     dset = DependencyDict(key=lambda x: -x[0])
+#     import random
+#     import time
 #
+#     dset = DependencyDict(key=lambda x: -x[0])
 #     ct = 1000
-#     import random
+#     rand, sample, randrange = random.random, random.sample, random.randrange
 #     for ix in range(ct):
-#         obj = ix
-#         before = set()
-#         after = set()
-#         pending = set()
+#         before = after = None
 #
-#         # Decide what our odds of having 'before' items are.
+#         # Decide what our odds of having 'before' items are.  (DependencyItem copies these, so no need for sets.)
 #         p = ix/(ct-1)
-#         if random.random() > (0.85 * p):
-#             after = set(random.sample(range(0, ix), random.randrange(1 + int(0.10*ix))))
-#         if random.random() > (0.65 * (1-p)):
-#             before = set(random.sample(range(ix+1, ct), random.randrange(1 + int(0.10*(ct - ix - 1)))))
-#         dset.add(obj, before, after)
+#         if rand() > (0.85 * p):
+#             after = sample(range(0, ix), randrange(1 + int(0.10*ix)))
+#         if rand() > (0.65 * (1-p)):
+#             before = sample(range(ix+1, ct), randrange(1 + int(0.10*(ct - ix - 1))))
+#         dset.add(ix, before, after)
+#
+#     start = time.perf_counter()
+#     dset.solve()
+#     print("Solved {} items in {} passes ({:.4f}s)".format(ct, dset._passes, time.perf_counter() - start))
 #     print(", ".join(str(x) for x in dset))
 #
-